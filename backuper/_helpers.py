@@ -4,27 +4,112 @@ Various maintenance tools.
 
 import os
 import concurrent.futures
+import itertools
 import logging
+import random
 import time
+from collections import defaultdict
 
-from backuper import database, settings
+from backuper import database, settings, googledrive
 from pytools import progressbar
 
 
+EXISTS_THREADS = 32
+
+
+class BatchThrottle:
+    """Paces batch requests. The interval between the starts of two batches doubles 
+    every time a batch gets rate limited or hits a server error and shrinks again 
+    with each successful batch.
+
+    min_interval: minimum number of seconds between the starts of two batches.
+    """
+
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self.interval = min_interval
+        self._start = 0
+        self._next_batch_time = 0
+
+    def wait(self):
+        """Call before each batch."""
+        time.sleep(max(0, self._next_batch_time - time.monotonic()))
+        self._start = time.monotonic()
+
+    def done(self, throttled):
+        """Call after each batch."""
+        if throttled:
+            self.interval = max(2 * self.interval, 1.0)
+            logging.warning("THROTTLED: batch interval increased to {:.2f}s.".format(self.interval))
+        else:
+            self.interval = max(self.min_interval, self.interval - 0.25)
+        # Jitter, so that retries don't line up with the rate limit window.
+        self._next_batch_time = self._start + self.interval * random.uniform(1, 1.25)
+
+
+def batch_delete_in_google_drive(google, paths, removed_ids, min_interval=1.0, pbar=None, throttle=None):
+    """Delete files from Google Drive in throttled batches.
+
+    paths: dict of drive_id -> local path (for logging)
+    removed_ids: list, filled with the ids of deleted (or already missing) 
+                 files, even if an exception is raised
+    min_interval: minimum number of seconds between the starts of two batches.
+    throttle: a BatchThrottle to keep the pace across calls (instead of min_interval).
+    
+    Rate limited files are retried after all other batches.
+    Sleeping happens between batches, never inside the batch callbacks.
+    """
+    RETRY_LIMIT = 5
+
+    retry_ids = []
+    retry_error = None
+    throttled = False  # In the current batch.
+    if throttle is None:
+        throttle = BatchThrottle(min_interval)
+    if pbar is None:
+        pbar = progressbar.progressbar(total=len(paths))
+
+    def _batch_delete_callback(file_id, _, exception):
+        nonlocal retry_error, throttled
+        if exception is not None:
+            if googledrive.is_retryable_error(exception):
+                retry_error = exception
+                throttled = True
+                retry_ids.append(file_id)
+                return
+            if exception.resp.status != 404:
+                raise exception
+            logging.warning("IGNORING: " + repr(exception))  # File does not exist.
+        pbar.update()
+        logging.info("Removed {} ({}) from Google Drive.".format(file_id, paths[file_id]))
+        removed_ids.append(file_id)
+
+    ids = list(paths)
+    for _ in range(RETRY_LIMIT + 1):
+        for i in range(0, len(ids), google.BATCH_LIMIT):
+            throttle.wait()
+            throttled = False
+            google.batch_delete(ids[i:i + google.BATCH_LIMIT], callback=_batch_delete_callback)
+            throttle.done(throttled)
+        if not retry_ids:
+            return
+        ids = list(retry_ids)
+        retry_ids.clear()
+    raise retry_error
+
 def get_unarchived_files_in_google_drive(google, folder_id):
     db = database.GoogleDriveDB()
+    # A single query instead of one per walked file.
+    archived_ids = { row[0] for row in db.model.select(db.model.drive_id).tuples().iterator() }
+    db.close()
     
-    for dirpath, dirnames, filenames in google.walk_folder(folder_id, fields="files(id,name)"):
+    for dirpath, dirnames, filenames in google.walk_folder(folder_id, fields="files(id)"):
         file_id = dirpath[1]
-        archive = db.get("drive_id", file_id)
-        if archive is None: yield file_id
+        if file_id not in archived_ids: yield file_id
 
         for resp in filenames:
             file_id = resp["id"]
-            archive = db.get("drive_id", file_id)
-            if archive is None: yield file_id
-
-    db.close()
+            if file_id not in archived_ids: yield file_id
 
 def delete_unarchived_files_in_google_drive(google, folder_id):
     ids = list(get_unarchived_files_in_google_drive(google, folder_id))
@@ -38,17 +123,49 @@ def remove_gd_nonexistent_from_db(google, config):
     print("Removing non-existent files in Google Drive from the database ...")
     logging.info("remove_gd_nonexistent_from_db()")
 
+    CHUNK_SIZE = 500
+
     with database.GoogleDriveDB() as db:
-        for archive in db.model.select().iterator():
-            if google.exists(archive.drive_id): continue
-            if not os.path.exists(archive.path) or config.is_blacklisted(archive.path):
-                logging.info("Removed {} from database.".format(archive.path))
-                archive.delete_instance()
+        model = db.model
+        removed_ids = []
+        archives = list(model.select(model.id, model.path, model.drive_id).namedtuples().iterator())
+        try:
+            # Existence is checked with batch requests, a chunk of archives at a time.
+            for i in range(0, len(archives), CHUNK_SIZE):
+                chunk = archives[i:i + CHUNK_SIZE]
+                existing = google.batch_exists(archive.drive_id for archive in chunk)
+                for archive in chunk:
+                    if archive.drive_id in existing: continue
+                    if not os.path.exists(archive.path) or config.is_blacklisted(archive.path):
+                        logging.info("Removed {} from database.".format(archive.path))
+                        removed_ids.append(archive.id)
+        finally:
+            db.remove_many("id", removed_ids)
 
 def get_all_removed_from_local_db():
+    """Yields (id, path, drive_id) named tuples of archives that don't exist locally."""
+    # Instead of a stat call per archive, list each parent directory once.
+    by_parent = defaultdict(list)
     with database.GoogleDriveDB() as db:
-        for archive in db:
-            if not os.path.exists(archive.path):
+        model = db.model
+        query = model.select(model.id, model.path, model.drive_id).namedtuples()
+        for archive in query.iterator():
+            by_parent[os.path.dirname(archive.path)].append(archive)
+
+    for parent, archives in by_parent.items():
+        try:
+            with os.scandir(parent) as it:
+                # Archived paths are unified (normcase).
+                names = { database.unify_str(entry.name) for entry in it }
+        except (FileNotFoundError, NotADirectoryError):  # The parent is gone.
+            names = set()
+        except OSError as e:
+            # E.g. no permission to list it. Its files may well exist, keep them.
+            logging.warning("Skipping {}: {}".format(parent, e))
+            continue
+        for archive in archives:
+            # The listing is only a hint. Don't delete anything that still exists.
+            if os.path.basename(archive.path) not in names and not os.path.exists(archive.path):
                 yield archive
 
 def delete_all_removed_from_local_db_batched(google):
@@ -56,42 +173,31 @@ def delete_all_removed_from_local_db_batched(google):
 
     print("\rDeleting files removed from disk from Google Drive ...")    
     
-    RETRY_LIMIT = 5
+    FLUSH_SIZE = 500
 
     db = database.GoogleDriveDB()
 
-    ids = { rem.drive_id for rem in get_all_removed_from_local_db() }
-    retry_ids = set()
-    retry_count = 0
-    pbar = progressbar.progressbar(total=len(ids))
-
-    def _batch_delete_callback(file_id, _, exception):
-        nonlocal retry_count
-        if exception is not None and exception.resp.status != 404:
-            if exception.resp.status == 403:  # Rate limit exceeded (probably).
-                if retry_count >= RETRY_LIMIT:
-                    raise exception
-                logging.warning("RETRYING:" + repr(exception))
-                retry_ids.add(file_id)
-                time.sleep(2**retry_count)
-                retry_count += 1
-            else:
-                raise exception
-        else:
-            if exception is not None and exception.resp.status == 404:  # File does not exist.
-                logging.warning("IGNORING: " + repr(exception))
-            retry_count = 0
-            archive = db.get("drive_id", file_id)
-            pbar.update()
-            logging.info("Removed {} ({}) from database and/or Google Drive.".format(archive.drive_id, archive.path))
-            archive.delete_instance()
-    
-    google.batch_delete(ids, callback=_batch_delete_callback)
-    while len(retry_ids) > 0:
-        ids = set(retry_ids)
-        retry_ids.clear()
-        google.batch_delete(ids, callback=_batch_delete_callback)
-    db.close()
+    removed_ids = []  # Deleted from Google Drive, but still in the database.
+    # Deleting starts while the remaining directories are still being scanned,
+    # so the number of archives is only an upper bound.
+    pbar = progressbar.progressbar(total=db.model.select().count())
+    removed = get_all_removed_from_local_db()
+
+    # Batches aren't throttled until Google Drive rate limits them.
+    # A single throttle keeps the pace from one chunk to the next.
+    throttle = BatchThrottle(min_interval=0)
+    try:
+        while True:
+            # drive_id -> path, so that logging doesn't have to query the database.
+            chunk = { rem.drive_id: rem.path for rem in itertools.islice(removed, FLUSH_SIZE) }
+            if not chunk:
+                break
+            batch_delete_in_google_drive(google, chunk, removed_ids, pbar=pbar, throttle=throttle)
+            db.remove_many("drive_id", removed_ids)
+            removed_ids.clear()
+    finally:
+        db.remove_many("drive_id", removed_ids)
+        db.close()
 
 def delete_all_removed_from_local_db(google):
     """:WARNING: Delete files removed from disk from Google Drive and the database."""
@@ -105,19 +211,28 @@ def delete_all_removed_from_local_db(google):
 
     db = database.GoogleDriveDB()
     archives = list(get_all_removed_from_local_db())
-    for archive in progressbar.progressbar(archives):
-        google.delete(archive.drive_id)
-        logging.info("Removed {} ({}) from database and/or Google Drive.".format(archive.drive_id, archive.path))
-        archive.delete_instance()
-    db.close()
+    removed_ids = []
+    try:
+        for archive in progressbar.progressbar(archives):
+            google.delete(archive.drive_id)
+            logging.info("Removed {} ({}) from database and/or Google Drive.".format(archive.drive_id, archive.path))
+            removed_ids.append(archive.id)
+    finally:
+        # Remove whatever got deleted, even if something went wrong.
+        db.remove_many("id", removed_ids)
+        db.close()
 
 def get_blacklisted_archives():
     SETTINGS_FILE = "_settings.ini"
     DATA_FILE = "_backuper.ini"
     conf = settings.Settings(SETTINGS_FILE, DATA_FILE)
+    # Archives share parent directories, which only need to be checked once.
+    memo = dict()
     with database.GoogleDriveDB() as db:
-        for archive in db.model.select().iterator():
-            if conf.is_blacklisted_parent(archive.path, conf.sync_dirs):
+        model = db.model
+        query = model.select(model.id, model.path, model.drive_id).namedtuples()
+        for archive in query.iterator():
+            if conf.is_blacklisted_parent(archive.path, conf.sync_dirs, memo):
                 yield archive
 
 def remove_blacklisted_paths(google):
@@ -126,12 +241,13 @@ def remove_blacklisted_paths(google):
     print("Deleting blacklisted files from Google Drive ...")
     
     db = database.GoogleDriveDB()
-    archives = list(get_blacklisted_archives())
-    for archive in progressbar.progressbar(archives):
-        google.delete(archive.drive_id)
-        logging.info("Removed {} ({}) from database and/or Google Drive.".format(archive.drive_id, archive.path))
-        archive.delete_instance()
-    db.close()
+    paths = { archive.drive_id: archive.path for archive in get_blacklisted_archives() }
+    removed_ids = []
+    try:
+        batch_delete_in_google_drive(google, paths, removed_ids)
+    finally:
+        db.remove_many("drive_id", removed_ids)
+        db.close()
 
 def delete_nonlocal_in_gd(google, folder_id, dry_run=False):
     """Removes all files in the given remote folder that don't exist locally. SLOW. """
@@ -147,10 +263,10 @@ def delete_nonlocal_in_gd(google, folder_id, dry_run=False):
     for dirpath, dirnames, filenames in google.walk_folder(folder_id):
         remote_path, file_id = dirpath
         # print(remote_path)
-        archive = db.get("drive_id", file_id)
-        if archive:
-            if not os.path.exists(archive.path):
-                removed_archived.append(archive)
+        path = db.get_cached_path(file_id)
+        if path:
+            if not os.path.exists(path):
+                removed_archived.append((file_id, path))
                 dirnames.clear()
                 continue
         else:
@@ -165,64 +281,95 @@ def delete_nonlocal_in_gd(google, folder_id, dry_run=False):
 
         for resp in filenames:
             file_id = resp["id"]
-            archive = db.get("drive_id", file_id)
-            if archive:
-                if not os.path.exists(archive.path):
-                    removed_archived.append(archive)
+            path = db.get_cached_path(file_id)
+            if path:
+                if not os.path.exists(path):
+                    removed_archived.append((file_id, path))
             else:
                 name = resp["name"]
                 removed_unarchived.append((file_id, os.path.join(remote_path, name)))
 
-    # Database entries are removed because the files in question exist
-    # neither locally nor remotely.
-    for archive in removed_archived:
-        # If a folder got removed, all children got removed as well.
-        if dry_run:
-            print(archive.drive_id, archive.path)
-        else:
-            google.delete(archive.drive_id)
-            logging.info("Removed {} ({}) from database and Google Drive.".format(archive.drive_id, archive.path))
-            q = db.model.delete().where(db.model.path.startswith(archive.path))
-            q.execute()
-    for file_id, remote_path in removed_unarchived:
-        if dry_run:
-            print(file_id, remote_path)
-        else:
-            google.delete(file_id)  # logging.info in google.delete
+    if dry_run:
+        for drive_id, path in removed_archived + removed_unarchived:
+            print(drive_id, path)
+        db.close()
+        return
 
-    db.close()
+    # Database entries are removed because the files in question exist
+    # neither locally nor remotely. If a folder got removed, all children 
+    # got removed as well.
+    removed_paths = dict(removed_archived)  # drive_id -> path
+    removed_ids = []
+    throttle = BatchThrottle()  # Shared by both deletes.
+    try:
+        try:
+            batch_delete_in_google_drive(google, removed_paths, removed_ids, throttle=throttle)
+        finally:
+            # Remove whatever got deleted, even if something went wrong.
+            model = db.model
+            archive_ids = []
+            for drive_id in removed_ids:
+                path = removed_paths[drive_id]
+                q = model.select(model.id).where((model.path == path) | model.path.startswith(path + os.sep))
+                archive_ids.extend(row[0] for row in q.tuples().iterator())
+            db.remove_many("id", archive_ids)
+
+        batch_delete_in_google_drive(google, dict(removed_unarchived), [], throttle=throttle)
+    finally:
+        db.close()
+
+def group_by_root(archives):
+    """Group archives (with id, path and drive_id) under their topmost archived folders.
+    
+    Returns (roots, children): roots maps a root's drive_id to its path and children
+    maps it to the ids of the root and all archives inside it.
+    """
+    roots = dict()  # drive_id -> path
+    children = defaultdict(list)  # root drive_id -> archive ids
+    root = None
+    # Sorted by path components, a folder's contents directly follow it. As plain
+    # strings, "/a/b.txt" would sort between "/a/b" and "/a/b/c".
+    for archive in sorted(archives, key=lambda archive: archive.path.split(os.sep)):
+        # "/a/bc" is not inside "/a/b".
+        if root is None or not archive.path.startswith(roots[root] + os.sep):
+            root = archive.drive_id
+            roots[root] = archive.path
+        children[root].append(archive.id)
+    return roots, children
 
 def delete_removed_from_local_db(google, local_path, dry_run=False):
     print("Deleting files removed from database from Google Drive ({}) ...".format(local_path) + (" (dry)" if dry_run else ""))
 
     db = database.GoogleDriveDB()
     
-    archives = []
-    q = db.model.select().where(db.model.path.startswith(local_path))
-    for archive in q.namedtuples().iterator():
-        if not os.path.exists(archive.path):
-            archives.append(archive)
+    # A single pass over the database. Children of a removed folder are missing
+    # as well, so they are already among the archives (see group_by_root).
+    model = db.model
+    q = (model.select(model.id, model.path, model.drive_id)
+         .where(model.path.startswith(local_path)))
+    archives = list(q.namedtuples().iterator())
+    # Existence checks block on I/O (slow on network drives), so run them concurrently.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EXISTS_THREADS) as executor:
+        exists = list(executor.map(os.path.exists, (archive.path for archive in archives)))
+    archives = [archive for archive, found in zip(archives, exists) if not found]
     
-    removed = set()
-    for archive in archives:
-        if dry_run: 
+    if dry_run:
+        for archive in archives:
             print(archive.path, archive.drive_id)
-            continue
-
-        # Minimizing GD API calls is key for speed.
-        if archive.drive_id in removed: 
-            continue
-
-        print(archive.path, archive.drive_id)
-        google.delete(archive.drive_id)
-        # If this is a folder, then all the children will get removed as well.
-        q = db.model.select().where(db.model.path.startswith(archive.path))
-        for arch in q.iterator():
-            removed.add(arch.drive_id)
-            arch.delete_instance()
-            logging.info("Removed {} ({}) from database and Google Drive.".format(arch.drive_id, arch.path))
-
-    db.close()
+        db.close()
+        return
+
+    # Minimizing GD API calls is key for speed.
+    # If a folder gets removed, then all the children get removed as well.
+    roots, children = group_by_root(archives)
+
+    removed_roots = []
+    try:
+        batch_delete_in_google_drive(google, roots, removed_roots)
+    finally:
+        removed_ids = [arch_id for root in removed_roots for arch_id in children[root]]
+        db.remove_many("id", removed_ids)
+        db.close()
 
 
 if __name__ == "__main__":
@@ -6,25 +6,40 @@ from concurrent.futures import ThreadPoolExecutor
 
 
 class _Queue(queue.Queue):
+    exception = None  # Set by a worker thread that raised an exception.
+
+    def put(self, item, block=True, timeout=None):
+        # Once a worker failed, new items would only get drained. Drop them,
+        # so that producers can't block on a bounded queue forever.
+        if self.exception is not None and item is not None:
+            return
+        super().put(item, block=block, timeout=timeout)
+
     def drain(self):
-        while True:
-            try:
-                self.get_nowait()
-                self.task_done()
-            except queue.Empty:
-                break
+        # Drop all queued items at once, instead of a get/task_done pair per item.
+        with self.mutex:
+            n = len(self.queue)
+            self.queue.clear()
+            self.unfinished_tasks = max(self.unfinished_tasks - n, 0)
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+            self.not_full.notify_all()
 
 
-def start_queue(fn, n_threads=5, thread_prefix="_loader"):
+def start_queue(fn, n_threads=5, thread_prefix="_loader", maxsize=0):
     """N threads will use 'fn' to process items from a queue, until the queue is empty.
     
     fn: (QItem) -> None.
 
+    If maxsize > 0, put() blocks while the queue is full, so that producers
+    can't run ahead of the threads (back-pressure). maxsize is at least n_threads.
+
     If a thread raises an exception, that exception will be raised when calling
     wait_for_queue. The queue will get drained and threads will be stopped
     as soon as they finish processing their current items.
     """
-    q = _Queue()
+    # wait_for_queue must be able to put n_threads stop items into an empty queue.
+    q = _Queue(maxsize=max(maxsize, n_threads) if maxsize > 0 else 0)
     q.n_threads = n_threads  # A convenience attribute.
     executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix=thread_prefix)
     for i in range(n_threads):
@@ -59,7 +74,7 @@ def wait_for_queue(q, stop=True):
     # Block until all tasks are done.
     q.join()
 
-    exception = getattr(q, "exception", None)
+    exception = q.exception
 
     # Stop worker threads.
     if stop or exception is not None:
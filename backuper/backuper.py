@@ -6,7 +6,7 @@ import concurrent.futures
 
 from pytools import filetools as ft
 
-from . import settings, googledrive, uploader, downloader, filecrawler, treelog, database, _helpers
+from . import settings, googledrive, uploader, downloader, filecrawler, treelog, database, fsutil, _helpers
 
 # Guarantee: no files will be deleted from the local file system!
 
@@ -20,6 +20,11 @@ class Backuper:
         self.conf = settings.Settings(SETTINGS_FILE, DATA_FILE)
         self.upload_threads = self.conf.user_settings_file.get_int("upload_threads")
         self.download_threads = self.conf.user_settings_file.get_int("download_threads")
+        # Settings files written before this option existed don't have it.
+        self.crawler_threads = self.conf.user_settings_file.get_int("crawler_threads", fallback=8)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_threads, thread_name_prefix="Backuper")
+        # Shared by all local walks, instead of a new pool per walk.
+        self.crawler_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.crawler_threads, thread_name_prefix="LocalFileCrawler")
         
         if pretty_log:
             dirpath = ft.create_dir("logs")
@@ -42,47 +47,48 @@ class Backuper:
         self.conf.data_file.init_values(self.google)
 
     def exit(self):
+        self.executor.shutdown()
+        self.crawler_executor.shutdown()
         self.google.exit()
         self.conf.exit()
         database.GoogleDriveDB.close()
 
     def list_upload_changes(self):
         print("Listing changes to upload ...")
-        file_crawler = filecrawler.LocalFileCrawler(self.conf)
+        file_crawler = filecrawler.LocalFileCrawler(self.conf, executor=self.crawler_executor)
         for dirpath in self.conf.sync_dirs:
             for path in file_crawler.get_all_paths_to_sync(dirpath):
                 print(path)
 
     def upload_changes(self):
         print("Uploading changes ...")
+        fsutil.clear_cache()
         gd_uploader = uploader.DBDriveUploader(self.google, self.conf.get_root_folder_id(self.google))
-        # First, the folder structure must be made so that files can be placed
-        # in the correct directories. This can't be queued because the order is 
-        # important.
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_threads, thread_name_prefix="Backuper") as ex:
-            futures = []
-            for dirpath in self.conf.sync_dirs:
-                futures.append(ex.submit(self._upload_folder_structure, dirpath, gd_uploader))
-            for fut in concurrent.futures.as_completed(futures):
-                fut.result()  # Re-raise the exception, if it occurred once all threads are done.
-
-        # Now, we can upload the files.
         q = gd_uploader.start_upload_queue(n_threads=self.upload_threads)
+        # Each sync dir is walked once (concurrently). Folders must be created before 
+        # files can be placed in them, so they aren't queued, but created as they are walked.
+        # The crawler holds no per-walk state, so the walks can share it.
+        file_crawler = filecrawler.LocalFileCrawler(self.conf, executor=self.crawler_executor)
+        futures = []
         for dirpath in self.conf.sync_dirs:
-            self._enqueue_path_changes(dirpath, q)
-        gd_uploader.wait_for_queue(q)
+            futures.append(self.executor.submit(self._upload_path_changes, dirpath, gd_uploader, q, file_crawler))
+        try:
+            concurrent.futures.wait(futures)
+        finally:
+            gd_uploader.wait_for_queue(q)
+        for fut in futures:
+            fut.result()  # Re-raise the exception, if it occurred once all threads are done.
 
         self.conf.data_file.set_last_upload_time()
 
-    def _upload_folder_structure(self, dirpath, gd_uploader):
-        file_crawler = filecrawler.LocalFileCrawler(self.conf)
-        for folder in file_crawler.get_folders_to_sync(dirpath):
-            gd_uploader.create_dir(folder)
-
-    def _enqueue_path_changes(self, dirpath, q): 
-        file_crawler = filecrawler.LocalFileCrawler(self.conf)
-        for fpath in file_crawler.get_files_to_sync(dirpath):
-            q.put(fpath)
+    def _upload_path_changes(self, dirpath, gd_uploader, q, file_crawler):
+        refreshed = []
+        for path, is_dir in file_crawler.get_all_entries_to_sync(dirpath, refreshed=refreshed):
+            if is_dir: gd_uploader.create_dir(path)
+            else: q.put(path)
+        # Touched, but unchanged files: store their new modification times.
+        for row in refreshed:
+            database.GoogleDriveDB.create_or_update_deferred(**row)
 
     def handle_download_conflicts(self, conflicts, dry_run=False):
         print("Handling download conflicts ..." + (" (dry)" if dry_run else ""))
@@ -142,8 +148,8 @@ class Backuper:
 
     def download_changes(self, dry_run=False):
         print("Downloading changes ..." + (" (dry)" if dry_run else ""))
-        db = database.GoogleDriveDB()
-        crawler = filecrawler.DriveFileCrawler(self.conf, self.google)
+        db = database.GoogleDriveDB  # Opened in __init__.
+        crawler = filecrawler.DriveFileCrawler(self.conf, self.google, executor=self.crawler_executor)
         gd_downloader = downloader.DriveDownloader(self.google)
         Entry = gd_downloader.DLQEntry
 
@@ -165,8 +171,7 @@ class Backuper:
             root_parent_id = obj.root_parent_id
 
             mid_path = self.google.get_remote_path(parent_id, root_parent_id).strip(os.path.sep)
-            archive = db.get("drive_id", root_parent_id)
-            pre_path = archive.path if archive else tracked_map[root_parent_id]
+            pre_path = db.get_cached_path(root_parent_id) or tracked_map[root_parent_id]
             return os.path.join(pre_path, mid_path, name)
 
         def enqueue(q, obj, path):
@@ -214,7 +219,7 @@ class Backuper:
         will remain. Otherwise, the mirror will be fully representative of
         the local path.
         """
-        db = database.GoogleDriveDB()
+        db = database.GoogleDriveDB  # Opened in __init__.
         if folder_id is None:
             entry = database.unify_path(path)
             archive = db.get("path", entry)
@@ -250,9 +255,10 @@ class Backuper:
         if not os.path.exists(local_path): return
 
         print("Full upload sync {} => {} ...".format(local_path, folder_id) + (" (dry)" if dry_run else ""))
+        fsutil.clear_cache()
 
         gd_uploader = uploader.DBDriveUploader(self.google, folder_id)
-        file_crawler = filecrawler.LocalFileCrawler(self.conf)
+        file_crawler = filecrawler.LocalFileCrawler(self.conf, executor=self.crawler_executor)
         
         # Link folder_id and local_path manually, so that no new base folder
         # is created inside folder_id.
@@ -260,23 +266,26 @@ class Backuper:
             entry = database.unify_path(local_path)
             _db = database.GoogleDriveDB
             _db.create_or_update(path=entry, drive_id=folder_id, 
-                date_modified_on_disk=ft.date_modified(entry), md5sum=_db.FOLDER_MD5)
-
-        for folder in file_crawler.get_folders_to_sync(local_path):
-            if dry_run: print(folder)
-            else: gd_uploader.create_dir(folder)
+                md5sum=_db.FOLDER_MD5, **database.date_fields(entry))
 
+        # A single walk. Folders are created before their contents are queued.
         q = gd_uploader.start_upload_queue(n_threads=self.upload_threads)
-        for fpath in file_crawler.get_files_to_sync(local_path):
-            if dry_run: print(fpath)
-            else: q.put(fpath)
-        gd_uploader.wait_for_queue(q)
+        refreshed = None if dry_run else []
+        try:
+            for path, is_dir in file_crawler.get_all_entries_to_sync(local_path, refreshed=refreshed):
+                if dry_run: print(path)
+                elif is_dir: gd_uploader.create_dir(path)
+                else: q.put(path)
+            for row in refreshed or []:
+                database.GoogleDriveDB.create_or_update_deferred(**row)
+        finally:
+            gd_uploader.wait_for_queue(q)
 
     def full_download_sync(self, folder_id, local_path, dry_run=False):
         print("Full download sync {} => {} ...".format(folder_id, local_path) + (" (dry)" if dry_run else ""))
 
         gd_downloader = downloader.DriveDownloader(self.google)
-        crawler = filecrawler.DriveFileCrawler(self.conf, self.google)
+        crawler = filecrawler.DriveFileCrawler(self.conf, self.google, executor=self.crawler_executor)
         Entry = gd_downloader.DLQEntry
         
         def enqueue(q, obj, path):
@@ -313,8 +322,8 @@ class Backuper:
         self.full_download_sync(folder_id, local_path, dry_run=dry_run)
 
     def get_removed_from_gd(self, update_token):
-        db = database.GoogleDriveDB()
-        crawler = filecrawler.DriveFileCrawler(self.conf, self.google)
+        db = database.GoogleDriveDB  # Opened in __init__.
+        crawler = filecrawler.DriveFileCrawler(self.conf, self.google, executor=self.crawler_executor)
         for removed_file_id in crawler.get_last_removed(update_token=update_token):
             archive = db.get("drive_id", removed_file_id)
             if archive:
@@ -328,26 +337,28 @@ class Backuper:
     def blacklist_removed_from_gd(self):
         print("Blacklisting files removed from Google Drive ...")
         # Reason: if a file is removed from GD, we don't want to reupload it.
+        # The blacklist is only saved once (clean_blacklisted_paths) and the
+        # archives are removed all at once.
+        removed_paths = []
         for archive in self.get_removed_from_gd(True):
             print(archive.path, archive.drive_id)
             # If a folder got removed, all children got removed as well.
             # However, only the root directory needs to be blacklisted.
             self.conf.blacklist_path(archive.path)
-            model = database.GoogleDriveDB.model
-            q = model.delete().where(model.path.contains(archive.path))
-            q.execute()
+            removed_paths.append(archive.path)
+        database.GoogleDriveDB.remove_containing(removed_paths)
         self.conf.clean_blacklisted_paths()
         # TODO: use the database instead of the data file to store the blacklist.
 
     def remove_db_removed_from_gd(self):
         print("Removing files removed from Google Drive from the database ...")
+        removed_paths = []
         for archive in self.get_removed_from_gd(True):
             print(archive.path, archive.drive_id)
             # If a folder got removed, all children got removed as well.
             self.conf.blacklist_path(archive.path)
-            model = database.GoogleDriveDB.model
-            q = model.delete().where(model.path.contains(archive.path))
-            q.execute()
+            removed_paths.append(archive.path)
+        database.GoogleDriveDB.remove_containing(removed_paths)
 
     def upload_tree_logs_zip(self):
         print("Creating and uploading trees ...")
@@ -1,14 +1,30 @@
 import os
 import logging
+import datetime
+import functools
+import operator
+import threading
 import concurrent.futures
 
 from pytools import filetools as ft
 
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
 
 
 DB_FILE_PATH = "archived.db"
-db = peewee.SqliteDatabase(DB_FILE_PATH)
+# WAL lets the loader threads read while another thread writes.
+DB_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,  # 64 MiB
+    "temp_store": "memory",
+    "mmap_size": 256 * 1024 ** 2
+}
+# Seconds a connection waits for another writer's lock before raising
+# "database is locked" (SQLite's busy timeout).
+DB_TIMEOUT = 30
+db = peewee.SqliteDatabase(DB_FILE_PATH, pragmas=DB_PRAGMAS, timeout=DB_TIMEOUT)
 
 
 class BaseModel(peewee.Model):
@@ -22,6 +38,9 @@ class DriveArchive(BaseModel):
     drive_id = peewee.CharField(unique=True)
     date_modified_on_disk = peewee.DateTimeField()
     md5sum = peewee.CharField(null=True)
+    # os.stat().st_mtime_ns on disk. Integers compare faster than dates.
+    # NULL for files archived before this field was added.
+    mtime_ns = peewee.BigIntegerField(null=True)
 
 
 class GoogleDriveDB:
@@ -31,6 +50,24 @@ class GoogleDriveDB:
     
     model = DriveArchive
 
+    # In-memory archive: path -> (drive_id, date_modified_on_disk, md5sum, mtime_ns).
+    # Loaded on the first cached lookup (see get_cached).
+    _cache = None
+    # drive_id -> path index of _cache (see get_cached_path).
+    _id_cache = None
+    _cache_lock = threading.Lock()
+
+    # Rows written by create_or_update_deferred, waiting for flush().
+    _pending = []
+    _pending_lock = threading.Lock()
+    FLUSH_SIZE = 500
+    # Full batches are flushed by a background writer, off the upload threads.
+    _writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="GoogleDriveDB")
+    # Batches must be written in order.
+    _flush_lock = threading.RLock()
+    # Set by a failed flush() and raised by the next one.
+    _flush_error = None
+
     def __init__(self):
         GoogleDriveDB.init()
 
@@ -43,14 +80,40 @@ class GoogleDriveDB:
     def __iter__(self):
         return GoogleDriveDB.model.select().iterator()
 
+    # init() and close() calls are counted, so that nested users (e.g. helpers 
+    # called during a Backuper session) share a single connection.
+    _users = 0
+    _schema_ready = False
+
     @staticmethod
     def init():
+        GoogleDriveDB._users += 1
         db.connect(reuse_if_open=True)
-        db.create_tables([GoogleDriveDB.model], safe=True)
+        if not GoogleDriveDB._schema_ready:
+            db.create_tables([GoogleDriveDB.model], safe=True)
+            GoogleDriveDB._add_missing_columns()
+            GoogleDriveDB._schema_ready = True
+
+    @staticmethod
+    def _add_missing_columns():
+        """Migrate databases created before a (nullable) field was added to the model."""
+        model = GoogleDriveDB.model
+        table = model._meta.table_name
+        existing = { column.name for column in db.get_columns(table) }
+        migrator = SqliteMigrator(db)
+        operations = [migrator.add_column(table, field.column_name, field)
+                      for field in model._meta.sorted_fields if field.column_name not in existing]
+        if operations:
+            logging.info("Adding database columns: {}".format(operations))
+            migrate(*operations)
 
     @staticmethod
     def close():
-        db.close()
+        """Flush deferred writes. The connection is closed by the last user."""
+        GoogleDriveDB.flush()
+        GoogleDriveDB._users = max(0, GoogleDriveDB._users - 1)
+        if GoogleDriveDB._users == 0:
+            db.close()
 
     @staticmethod
     def get(field, key, fallback=None):
@@ -60,38 +123,269 @@ class GoogleDriveDB:
         except GoogleDriveDB.model.DoesNotExist:
             return fallback
 
+    @staticmethod
+    def load_cache():
+        """Load the whole archive into memory with a single query."""
+        model = GoogleDriveDB.model
+        query = model.select(model.path, *GoogleDriveDB._cache_columns()).tuples()
+        cache = { row[0]: row[1:] for row in query.iterator() }
+        GoogleDriveDB._id_cache = { val[0]: path for path, val in cache.items() }
+        GoogleDriveDB._cache = cache
+
+    @staticmethod
+    def _cache_columns():
+        model = GoogleDriveDB.model
+        return model.drive_id, model.date_modified_on_disk, model.md5sum, model.mtime_ns
+
+    @staticmethod
+    def _cache_row(inst):
+        return inst.drive_id, inst.date_modified_on_disk, inst.md5sum, inst.mtime_ns
+
+    @staticmethod
+    def _set_cached(path, val):
+        old_val = GoogleDriveDB._cache.get(path)
+        # The path got a new drive_id (e.g. it was uploaded again). Forget the old one.
+        if old_val is not None and old_val[0] != val[0] and GoogleDriveDB._id_cache.get(old_val[0]) == path:
+            del GoogleDriveDB._id_cache[old_val[0]]
+        GoogleDriveDB._cache[path] = val
+        GoogleDriveDB._id_cache[val[0]] = path
+
+    @staticmethod
+    def _pop_cached(path):
+        val = GoogleDriveDB._cache.pop(path, None)
+        if val is not None and GoogleDriveDB._id_cache.get(val[0]) == path:
+            del GoogleDriveDB._id_cache[val[0]]
+
+    @staticmethod
+    def clear_cache():
+        """Call after modifying the database without using GoogleDriveDB's methods.
+        
+        Deferred rows are written first. When deleting or renaming rows, call flush()
+        before the statement instead, so the deferred rows can't bring them back.
+        """
+        GoogleDriveDB.flush()
+        GoogleDriveDB._reset_cache()
+
+    @staticmethod
+    def _reset_cache():
+        with GoogleDriveDB._cache_lock:
+            GoogleDriveDB._cache = None
+            GoogleDriveDB._id_cache = None
+
+    @staticmethod
+    def _get_cache():
+        with GoogleDriveDB._cache_lock:
+            if GoogleDriveDB._cache is None:
+                GoogleDriveDB.load_cache()
+            return GoogleDriveDB._cache
+
+    @staticmethod
+    def get_cached(path):
+        """Returns (drive_id, date_modified_on_disk, md5sum, mtime_ns) of the archived path or None.
+        
+        Lookups are answered from memory. The database is queried only on a miss.
+        """
+        cache = GoogleDriveDB._get_cache()
+        val = cache.get(path)
+        if val is None:
+            row = GoogleDriveDB._select_cache_row(GoogleDriveDB.model.path == path)
+            if row is not None:
+                val = row[1:]
+                GoogleDriveDB._set_cached(path, val)
+        return val
+
+    @staticmethod
+    def get_cached_path(drive_id):
+        """Returns the archived path of drive_id or None. Same as get_cached, but by drive_id."""
+        GoogleDriveDB._get_cache()
+        path = GoogleDriveDB._id_cache.get(drive_id)
+        if path is None:
+            row = GoogleDriveDB._select_cache_row(GoogleDriveDB.model.drive_id == drive_id)
+            if row is not None:
+                path = row[0]
+                GoogleDriveDB._set_cached(path, row[1:])
+        return path
+
+    @staticmethod
+    def _select_cache_row(where):
+        """Cache misses select only the cached columns (as a tuple), without creating a model instance."""
+        model = GoogleDriveDB.model
+        return model.select(model.path, *GoogleDriveDB._cache_columns()).where(where).tuples().first()
+
+    @staticmethod
+    def get_cached_many(paths):
+        """Batched get_cached. Returns a dict of the archived paths in paths.
+
+        Cache misses are looked up with a single query per chunk of paths.
+        """
+        cache = GoogleDriveDB._get_cache()
+        found = dict()
+        missing = []
+        for path in paths:
+            val = cache.get(path)
+            if val is None: missing.append(path)
+            else: found[path] = val
+
+        model = GoogleDriveDB.model
+        for batch in peewee.chunked(missing, 500):
+            query = (model.select(model.path, *GoogleDriveDB._cache_columns())
+                     .where(model.path.in_(batch)).tuples())
+            for row in query.iterator():
+                found[row[0]] = row[1:]
+                GoogleDriveDB._set_cached(row[0], row[1:])
+        return found
+
+    @staticmethod
+    def _update_cache(inst, old_path=None):
+        if GoogleDriveDB._cache is None:
+            return
+        if old_path is not None:
+            GoogleDriveDB._pop_cached(old_path)
+        GoogleDriveDB._set_cached(inst.path, GoogleDriveDB._cache_row(inst))
+
     @staticmethod
     def create(*args, **kwargs):
         with db.atomic():
-            return GoogleDriveDB.model.create(*args, **kwargs)
+            inst = GoogleDriveDB.model.create(*args, **kwargs)
+        GoogleDriveDB._update_cache(inst)
+        return inst
 
     @staticmethod
     def remove(field, key):
         inst = GoogleDriveDB.get(field, key)
         if inst is not None:
             inst.delete_instance()
+            if GoogleDriveDB._cache is not None:
+                GoogleDriveDB._pop_cached(inst.path)
+
+    @staticmethod
+    def remove_many(field, keys):
+        """Remove all archives whose field is in keys, in a single transaction."""
+        model = GoogleDriveDB.model
+        column = getattr(model, field)
+        # Deferred rows written after the delete would restore the removed archives.
+        GoogleDriveDB.flush()
+        with db.atomic():
+            for batch in peewee.chunked(keys, 500):
+                model.delete().where(column.in_(batch)).execute()
+        GoogleDriveDB._reset_cache()
+
+    @staticmethod
+    def remove_containing(paths):
+        """Remove all archives whose path contains any of paths. The table is scanned
+        once per chunk of paths, instead of once per path, in a single transaction."""
+        model = GoogleDriveDB.model
+        GoogleDriveDB.flush()
+        with db.atomic():
+            # Chunks keep the nested OR expression below SQLite's parser stack limit.
+            for batch in peewee.chunked(paths, 50):
+                where = functools.reduce(operator.or_, (model.path.contains(path) for path in batch))
+                model.delete().where(where).execute()
+        GoogleDriveDB._reset_cache()
 
     @staticmethod
     def update(inst, **kwargs):
+        old_path = inst.path
         for key, value in kwargs.items():
             setattr(inst, key, value)
-        return inst.save()
+        ret = inst.save()
+        GoogleDriveDB._update_cache(inst, old_path=old_path)
+        return ret
 
     @staticmethod
     def create_or_update(**kwargs):
-        # Use unique fields for the 'get' part. And the rest
+        """Create or update an archive. Returns the archive.
+        
+        Given all the NOT NULL fields, a single upsert statement is used. Otherwise,
+        the archive is looked up by its unique field and only the given fields are updated.
+        """
+        model = GoogleDriveDB.model
+        # Use unique fields for the conflict target. And the rest
         # for updating/creating.
         UNIQUE = ["drive_id", "path"]
-        get = dict()
-        for field in UNIQUE:
-            if field in kwargs:
-                get[field] = kwargs.pop(field)
-                break
+        REQUIRED = ["path", "drive_id", "date_modified_on_disk"]
+        field = next(field for field in UNIQUE if field in kwargs)
+        if not all(key in kwargs for key in REQUIRED):
+            # The insert part of an upsert would violate the NOT NULL constraints.
+            value = kwargs.pop(field)
+            inst, created = model.get_or_create(**{field: value}, defaults=kwargs)
+            if created:
+                GoogleDriveDB._update_cache(inst)
+            else:
+                GoogleDriveDB.update(inst, **kwargs)
+            return inst
+
+        preserve = [getattr(model, key) for key in kwargs if key != field]
+        query = model.insert(**kwargs).on_conflict(conflict_target=[getattr(model, field)], preserve=preserve)
+        query.execute()
+
+        if GoogleDriveDB._cache is not None:
+            # Drop the stale entries. They are reloaded on the next lookup.
+            if "drive_id" in kwargs:
+                old_path = GoogleDriveDB._id_cache.get(kwargs["drive_id"])
+                if old_path is not None:
+                    GoogleDriveDB._pop_cached(old_path)
+            if "path" in kwargs:
+                GoogleDriveDB._pop_cached(kwargs["path"])
+        return model.get(getattr(model, field) == kwargs[field])
 
-        model, created = GoogleDriveDB.model.get_or_create(**get, defaults=kwargs)
-        if not created:
-            GoogleDriveDB.update(model, **kwargs)
-        return model
+    @staticmethod
+    def create_or_update_deferred(**kwargs):
+        """Same as create_or_update, except that the row is written by flush().
+        
+        Rows are written in batches inside a single transaction. Until then,
+        they are only visible through the cached lookups (get_cached, ...).
+        """
+        GoogleDriveDB._get_cache()
+        # A moved file (e.g. a download) keeps its drive_id. Forget its old path.
+        old_path = GoogleDriveDB._id_cache.get(kwargs["drive_id"])
+        if old_path is not None and old_path != kwargs["path"]:
+            GoogleDriveDB._pop_cached(old_path)
+        GoogleDriveDB._set_cached(kwargs["path"], (kwargs["drive_id"], kwargs["date_modified_on_disk"], 
+                                                   kwargs.get("md5sum"), kwargs.get("mtime_ns")))
+        with GoogleDriveDB._pending_lock:
+            GoogleDriveDB._pending.append(kwargs)
+            full = len(GoogleDriveDB._pending) == GoogleDriveDB.FLUSH_SIZE
+        if full:
+            GoogleDriveDB._writer.submit(GoogleDriveDB._background_flush)
+
+    @staticmethod
+    def _background_flush():
+        # Nobody waits for the writer. Keep the error for the next flush().
+        with GoogleDriveDB._flush_lock:
+            try:
+                GoogleDriveDB.flush()
+            except Exception as e:
+                logging.exception("Background database flush failed.")
+                GoogleDriveDB._flush_error = e
+
+    @staticmethod
+    def flush():
+        """Write all deferred rows to the database.
+        
+        If a write fails, the rows stay pending and the error is raised.
+        An error from a background flush is raised by the next call.
+        """
+        with GoogleDriveDB._flush_lock:
+            error = GoogleDriveDB._flush_error
+            if error is not None:
+                GoogleDriveDB._flush_error = None
+                raise error
+            with GoogleDriveDB._pending_lock:
+                rows = GoogleDriveDB._pending
+                GoogleDriveDB._pending = []
+            if not rows:
+                return
+            model = GoogleDriveDB.model
+            try:
+                with db.atomic():
+                    # Stay below SQLite's limit of host parameters per statement.
+                    for batch in peewee.chunked(rows, 100):
+                        model.insert_many(batch).on_conflict_replace().execute()
+            except Exception:
+                with GoogleDriveDB._pending_lock:
+                    GoogleDriveDB._pending = rows + GoogleDriveDB._pending
+                raise
 
     @staticmethod
     def get_parent_folder_id(path, fallback="root"):
@@ -99,8 +393,8 @@ class GoogleDriveDB:
 
     @staticmethod
     def get_stored_path_id(path, fallback=None):
-        val = GoogleDriveDB.get("path", path, fallback=None)
-        if val: return val.drive_id
+        val = GoogleDriveDB.get_cached(path)
+        if val: return val[0]
         return fallback
 
 
@@ -110,8 +404,28 @@ def unify_path(path):
     NOTE: on Windows all paths are case in-sensitive so normcase will 
     lower them. On UNIX paths are case sensitive, so normcase won't lower
     them!"""
+    # Relative paths depend on the working directory, so they can't be cached.
+    if not os.path.isabs(path):
+        return os.path.normcase(os.path.abspath(path))
+    return _unify_abs_path(path)
+
+@functools.lru_cache(maxsize=2**18)
+def _unify_abs_path(path):
+    # Called multiple times for every crawled path (and its parents).
     return os.path.normcase(os.path.abspath(path))
 
+def stat_date_modified(stat_result):
+    """ft.date_modified without the extra stat call."""
+    return datetime.datetime.fromtimestamp(stat_result.st_mtime)
+
+def stat_date_fields(stat_result):
+    """Returns the archive's date fields (as kwargs) of a file's os.stat() result."""
+    return { "date_modified_on_disk": stat_date_modified(stat_result),
+             "mtime_ns": stat_result.st_mtime_ns }
+
+def date_fields(path):
+    return stat_date_fields(os.stat(path))
+
 def unify_str(txt):
     return os.path.normcase(txt)
 
@@ -128,6 +442,12 @@ def rename_database_path(old_path, new_path):
     new_path = unify_path(new_path)
     
     with GoogleDriveDB() as db:
-        q = db.model.select().where(db.model.path.startswith(old_path))
-        for archive in q.iterator():
-            db.update(archive, path=archive.path.replace(old_path, new_path, count=1))
+        model = db.model
+        # Deferred rows written after the update would restore the old paths.
+        db.flush()
+        # Only (id, path) pairs are needed; don't build whole model instances.
+        q = model.select(model.id, model.path).where(model.path.startswith(old_path)).tuples()
+        with model._meta.database.atomic():
+            for archive_id, path in list(q.iterator()):
+                model.update(path=path.replace(old_path, new_path, 1)).where(model.id == archive_id).execute()
+        db._reset_cache()
@@ -1,8 +1,6 @@
 import os
 from collections import namedtuple
 
-from pytools import filetools as ft
-
 from . import database as db
 from . import _loader
 
@@ -25,24 +23,29 @@ class DriveDownloader:
         os.makedirs(path, exist_ok=True)
         if self.update_db:
             entry = db.unify_path(path)
-            db.GoogleDriveDB.create_or_update(path=entry, drive_id=folder_id, 
-                date_modified_on_disk=ft.date_modified(entry), md5sum=db.GoogleDriveDB.FOLDER_MD5)
+            db.GoogleDriveDB.create_or_update_deferred(path=entry, drive_id=folder_id, 
+                md5sum=db.GoogleDriveDB.FOLDER_MD5, **db.date_fields(entry))
 
     def download_file(self, file_id, dirpath, filename, md5sum):
         # The md5Checksum should be retrieved using the Google Drive API. 
         self.google.download_file(file_id, dirpath, filename=filename)
         if self.update_db:
             entry = db.unify_path(os.path.join(dirpath, filename))
-            db.GoogleDriveDB.create_or_update(path=entry, drive_id=file_id,
-                date_modified_on_disk=ft.date_modified(entry), md5sum=md5sum)
+            db.GoogleDriveDB.create_or_update_deferred(path=entry, drive_id=file_id,
+                md5sum=md5sum, **db.date_fields(entry))
+
+    # Download queues hold at most this many entries per thread.
+    QUEUE_SIZE_PER_THREAD = 4
 
     def start_download_queue(self, n_threads=5):
         """N threads will download items from a queue, until the queue is empty.
 
         Returns a DownloadQueue object. Populate the queue with DLQEntry objects
         using the queue's put() method. When done, call wait_for_queue(q).
+        put() blocks while the queue is full.
         """
-        return _loader.start_queue(self.process_queue_entry, n_threads=n_threads, thread_prefix="DriveDownloader")
+        return _loader.start_queue(self.process_queue_entry, n_threads=n_threads, thread_prefix="DriveDownloader",
+            maxsize=n_threads * self.QUEUE_SIZE_PER_THREAD)
 
     def process_queue_entry(self, entry):
         if entry.type == "#folder":
@@ -53,5 +56,9 @@ class DriveDownloader:
     def wait_for_queue(self, q, stop=True):
         """q must be a DownloadQueue returned by the start_download_queue method.
         If 'stop' is True, consider the queue unusable. Associated threads will stop.
+        Also writes the deferred database entries.
         """
-        return _loader.wait_for_queue(q, stop=stop)
+        try:
+            return _loader.wait_for_queue(q, stop=stop)
+        finally:
+            db.GoogleDriveDB.flush()
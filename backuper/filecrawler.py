@@ -1,53 +1,153 @@
 import os
+import contextlib
+import concurrent.futures
 from collections import namedtuple
 
-from pytools import filetools as ft
-
 from . import database as db
+from . import fsutil
 from . import googledrive
 
 
+@contextlib.contextmanager
+def _executor_or_pool(executor, n_threads):
+    if executor is not None:
+        yield executor  # Shut down by its owner.
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="FileCrawler") as executor:
+            yield executor
+
+
+def scandir_walk(top):
+    """Same as os.walk(top), except that dirnames and filenames are lists of 
+    os.DirEntry objects. Use their cached type and stat information to 
+    save system calls.
+    """
+    try:
+        scandir_it = os.scandir(top)
+    except OSError:
+        return
+
+    dirs = []
+    files = []
+    with scandir_it:
+        for entry in scandir_it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir: dirs.append(entry)
+            else: files.append(entry)
+
+    yield top, dirs, files
+
+    # Like os.walk, don't follow symbolic links to directories.
+    for entry in dirs:
+        if not entry.is_symlink():
+            yield from scandir_walk(entry.path)
+
+
 class LocalFileCrawler:
-    def __init__(self, settings):
+    def __init__(self, settings, n_threads=8, executor=None):
         self.conf = settings
+        # Threads used to check files for sync. Stat calls are slow on network drives.
+        self.n_threads = n_threads
+        # If given, walks share this executor instead of starting their own threads.
+        self.executor = executor
 
-    def is_for_sync(self, path):
-        """Note: make sure path is not blacklisted."""
+    def is_for_sync(self, path, stat_result=None, is_dir=None, refreshed=None):
+        """Note: make sure path is not blacklisted.
+        
+        stat_result (os.stat) and is_dir can be passed in if they are already known.
+
+        A file that was touched, but not changed, isn't for sync. If refreshed is 
+        a list, its archive row with the new modification time is appended to it, 
+        for the caller to store (see GoogleDriveDB.create_or_update_deferred).
+        The crawler itself never writes to the database.
+        """
         entry = db.unify_path(path)
-        archive = db.GoogleDriveDB.get("path", entry)
+        archive = db.GoogleDriveDB.get_cached(entry)
+        return self._is_archive_for_sync(archive, entry, stat_result=stat_result, is_dir=is_dir, refreshed=refreshed)
+
+    def _is_archive_for_sync(self, archive, entry, stat_result=None, is_dir=None, refreshed=None):
         if archive is not None:
             # Folder already exists in google drive.
-            return ft.date_modified(entry) > archive.date_modified_on_disk if not os.path.isdir(entry) else False
+            if is_dir is None:
+                is_dir = os.path.isdir(entry)
+            if is_dir:
+                return False
+            if stat_result is None:
+                stat_result = os.stat(entry)
+            drive_id, date_modified_on_disk, md5sum, mtime_ns = archive
+            if mtime_ns is not None:
+                modified = stat_result.st_mtime_ns > mtime_ns
+            else:  # Archived before mtime_ns was stored.
+                modified = db.stat_date_modified(stat_result) > date_modified_on_disk
+            if not modified:
+                return False
+            # The file was touched, but was it changed? Compare the contents,
+            # because hashing is cheaper than uploading.
+            if md5sum and fsutil.md5sum(entry) == md5sum:
+                if refreshed is not None:
+                    refreshed.append(dict(path=entry, drive_id=drive_id, md5sum=md5sum, 
+                                          **db.stat_date_fields(stat_result)))
+                return False
+            return True
         return True
 
+    def _executor(self):
+        return _executor_or_pool(self.executor, self.n_threads)
+
+    def _filter_for_sync(self, file_entries, executor, refreshed=None):
+        """Check file entries with is_for_sync. Archive lookups are batched
+        and stat calls are concurrent. Order is preserved."""
+        entries = [db.unify_path(e.path) for e in file_entries]
+        archives = db.GoogleDriveDB.get_cached_many(entries)
+
+        def check(dir_entry, entry):
+            archive = archives.get(entry)
+            if archive is None:  # Not archived, no need to stat.
+                return True
+            return self._is_archive_for_sync(archive, entry, stat_result=dir_entry.stat(), is_dir=False, refreshed=refreshed)
+
+        results = executor.map(check, file_entries, entries)
+        for dir_entry, for_sync in zip(file_entries, results):
+            if for_sync:
+                yield dir_entry.path
+
+    def _not_blacklisted(self, file_entries):
+        return [e for e in file_entries if not self.conf.is_blacklisted(e.path)]
+
+    def get_all_entries_to_sync(self, path, refreshed=None):
+        """Yields (path, is_dir) pairs of folders and files to sync, with a single walk.
+        Folders are yielded before their contents. For refreshed, see is_for_sync."""
+        with self._executor() as executor:
+            for root, dirs, files in scandir_walk(path):
+                if self.conf.is_blacklisted(root):
+                    dirs.clear()
+                    continue
+                if self.is_for_sync(root, is_dir=True):
+                    yield root, True
+                for fpath in self._filter_for_sync(self._not_blacklisted(files), executor, refreshed=refreshed):
+                    yield fpath, False
+
     def get_all_paths_to_sync(self, path):
-        for root, dirs, files in os.walk(path):
-            if self.conf.is_blacklisted(root):
-                dirs.clear()
-                continue
-            if self.is_for_sync(root):
-                yield root
-            for f in files:
-                f_path = os.path.join(root, f)
-                if not self.conf.is_blacklisted(f_path) and self.is_for_sync(f_path):
-                    yield f_path
+        for entry, _ in self.get_all_entries_to_sync(path):
+            yield entry
 
-    def get_files_to_sync(self, path):
-        for root, dirs, files in os.walk(path):
-            if self.conf.is_blacklisted(root):
-                dirs.clear()
-                continue
-            for f in files:
-                f_path = os.path.join(root, f)
-                if not self.conf.is_blacklisted(f_path) and self.is_for_sync(f_path):
-                    yield f_path
+    def get_files_to_sync(self, path, refreshed=None):
+        with self._executor() as executor:
+            for root, dirs, files in scandir_walk(path):
+                if self.conf.is_blacklisted(root):
+                    dirs.clear()
+                    continue
+                yield from self._filter_for_sync(self._not_blacklisted(files), executor, refreshed=refreshed)
 
     def get_folders_to_sync(self, path):
-        for root, dirs, files in os.walk(path):
+        for root, dirs, files in scandir_walk(path):
             if self.conf.is_blacklisted(root):
                 dirs.clear()
                 continue
-            if self.is_for_sync(root):
+            if self.is_for_sync(root, is_dir=True):
                 yield root
 
 
@@ -56,9 +156,31 @@ class DriveFileCrawler:
     NEUTRAL_FLAG = 0
     SAFE_FLAG = 1
 
-    def __init__(self, settings, google):
+    # Number of remote files checked concurrently (see _filter_for_download).
+    CHECK_CHUNK_SIZE = 64
+
+    def __init__(self, settings, google, n_threads=8, executor=None):
         self.conf = settings
         self.google = google
+        # Threads used to check (stat and hash) local copies of remote files.
+        self.n_threads = n_threads
+        # If given, checks share this executor instead of starting their own threads.
+        self.executor = executor
+
+    def _executor(self):
+        return _executor_or_pool(self.executor, self.n_threads)
+
+    def _filter_for_download(self, candidates, executor):
+        """Check (item, file_id, md5sum, remote_time) candidates with is_for_download.
+        Local files are hashed concurrently. Order is preserved.
+        Yields (item, sync_decision) pairs of candidates that aren't neutral."""
+        def check(candidate):
+            _, file_id, md5sum, remote_time = candidate
+            return self.is_for_download(file_id, md5sum, remote_time)
+
+        for candidate, decision in zip(candidates, executor.map(check, candidates)):
+            if decision != self.NEUTRAL_FLAG:
+                yield candidate[0], decision
 
     def is_for_download(self, file_id, file_md5, remote_time=None):
         """Check if a file on Google Drive is to be downloaded.
@@ -77,21 +199,26 @@ class DriveFileCrawler:
         # The first check is whether the file in the cloud is also in the
         # local database. If the file is not in the database, 
         # it can't hurt to download the file.
-        db_entry = db.GoogleDriveDB.get("drive_id", file_id)
-        if db_entry:
+        path = db.GoogleDriveDB.get_cached_path(file_id)
+        if path:
             # It is possible for a file to be in the database, despite being
             # blacklisted. In that case, we do not want to download it.
-            if self.conf.is_blacklisted(db_entry.path):
+            if self.conf.is_blacklisted(path):
                 return NEUTRAL_FLAG
 
             # The file has been deleted from the local file system. Was that intentional?
-            if not os.path.exists(db_entry.path):
+            # (One stat call for both the existence check and the modification date.)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
                 return CONFLICT_FLAG
 
+            _, date_modified_on_disk, db_md5, mtime_ns = db.GoogleDriveDB.get_cached(path)
+
             # We use md5 checksums because Google provides them when requesting files.
             # There are 3 different md5 checksums we can check: the local file, the 
             # one stored in the database and the one provided by Google.
-            # Note: db_entry.md5sum denotes the hash of the file of when it was uploaded 
+            # Note: db_md5 denotes the hash of the file of when it was uploaded 
             # to the remote.
             
             # Truth table for md5 comparison:
@@ -114,16 +241,20 @@ class DriveFileCrawler:
             # f_{1}  := not(p) and not(q) and r
             # f_{-1} := not(p) and not(q) and not(r)
 
-            local_md5 = ft.md5sum(db_entry.path)
-            p = file_md5 == db_entry.md5sum
+            # A file with exactly the archived modification time still has the
+            # archived checksum, so there's no need to read it. Any other time
+            # (including an older one, e.g. a restored backup) means hashing.
+            unchanged = mtime_ns is not None and stat_result.st_mtime_ns == mtime_ns
+            local_md5 = db_md5 if unchanged and db_md5 else fsutil.md5sum(path)
+            p = file_md5 == db_md5
             q = file_md5 == local_md5
-            r = local_md5 == db_entry.md5sum
+            r = local_md5 == db_md5
             if p or q: return NEUTRAL_FLAG
             if r: return SAFE_FLAG
 
             # The conflict might be resolved by looking at the change time ...
-            if remote_time is not None and (remote_time < db_entry.date_modified_on_disk \
-                                            or remote_time < ft.date_modified(db_entry.path)):
+            if remote_time is not None and (remote_time < date_modified_on_disk \
+                                            or remote_time < db.stat_date_modified(stat_result)):
                 return NEUTRAL_FLAG
             return CONFLICT_FLAG
         return SAFE_FLAG
@@ -173,7 +304,7 @@ class DriveFileCrawler:
 
             for parent_id in self.google.get_parents(parent_id):  # first, parent_id is yielded
                 if parent_id in blacklisted_ids: return None
-                if parent_id in root_ids or db.GoogleDriveDB.get("drive_id", parent_id):
+                if parent_id in root_ids or db.GoogleDriveDB.get_cached_path(parent_id):
                     return parent_id
             return None
 
@@ -181,25 +312,38 @@ class DriveFileCrawler:
             fields="changes(file(id, name, md5Checksum, modifiedTime, parents, trashed, mimeType))",
             include_removed=False)
 
-        last_download_sync_datetime = self.conf.data_file.get_last_download_sync_time(False)
-        for change in changes:
-            file_change = change["file"]
-            if file_change["trashed"]:
-                continue
-            change_datetime = googledrive.convert_google_time_to_datetime(file_change['modifiedTime'])
-            if change_datetime < last_download_sync_datetime:
-                continue
-            file_id = file_change["id"]
-            parent_id = file_change["parents"][0] if "parents" in file_change else None
-            root_parent_id = get_parent(file_id, parent_id)
-            if root_parent_id is None: 
-                continue
-            md5sum = file_change.get("md5Checksum", "")
-            decision = self.is_for_download(file_id, md5sum, change_datetime)
-            if decision != self.NEUTRAL_FLAG:
+        def filter_candidates(candidates, executor):
+            for (file_change, root_parent_id), decision in self._filter_for_download(candidates, executor):
                 _type = "#folder" if (file_change["mimeType"] == self.google.FOLDER_MIMETYPE) else "#file"
                 yield ret_type(decision, _type, file_change, root_parent_id)
 
+        last_download_sync_datetime = self.conf.data_file.get_last_download_sync_time(False)
+        # Parents are looked up in order (each change caches metadata for the next ones),
+        # then the local copies are checked concurrently, a chunk of changes at a time.
+        candidates = []
+        with self._executor() as executor:
+            for change in changes:
+                file_change = change["file"]
+                if file_change["trashed"]:
+                    continue
+                change_datetime = googledrive.convert_google_time_to_datetime(file_change['modifiedTime'])
+                if change_datetime < last_download_sync_datetime:
+                    continue
+                file_id = file_change["id"]
+                # The change already has the name and parents. Later parent lookups
+                # (of this file's children and for remote paths) then hit the cache.
+                self.google.cache_metadata(file_change)
+                parent_id = file_change["parents"][0] if "parents" in file_change else None
+                root_parent_id = get_parent(file_id, parent_id)
+                if root_parent_id is None: 
+                    continue
+                md5sum = file_change.get("md5Checksum", "")
+                candidates.append(((file_change, root_parent_id), file_id, md5sum, change_datetime))
+                if len(candidates) == self.CHECK_CHUNK_SIZE:
+                    yield from filter_candidates(candidates, executor)
+                    candidates = []
+            yield from filter_candidates(candidates, executor)
+
         if update_token:
             self.conf.data_file.set_last_download_change_token(self.google.get_start_page_token())
 
@@ -214,21 +358,23 @@ class DriveFileCrawler:
         remote path string: e.g. "\\My Drive\\Backuper\\file.py"
         """
         ret_type = DriveFileCrawler._ids_to_download_in_folder_obj
-        for dirpath, dirnames, filenames in self.google.walk_folder(folder_id, fields="files(id, md5Checksum, name, modifiedTime)"):
-            path, file_id = dirpath
-            md5sum = db.GoogleDriveDB.FOLDER_MD5
-            sync_decision = self.is_for_download(file_id, md5sum)
-            if sync_decision != self.NEUTRAL_FLAG:
-                yield ret_type(sync_decision, "#folder", file_id, path, md5sum)
-
-            for resp in filenames:
-                file_id = resp['id']
-                md5sum = resp.get("md5Checksum", db.GoogleDriveDB.FOLDER_MD5)
-                change_datetime = googledrive.convert_google_time_to_datetime(resp['modifiedTime'])
-                sync_decision = self.is_for_download(file_id, md5sum, change_datetime)
-
-                if sync_decision != self.NEUTRAL_FLAG:                
-                    yield ret_type(sync_decision, "#file", file_id, os.path.join(path, resp["name"]), md5sum)
+        with self._executor() as executor:
+            for dirpath, dirnames, filenames in self.google.walk_folder(folder_id, fields="files(id, md5Checksum, name, modifiedTime)"):
+                path, file_id = dirpath
+                md5sum = db.GoogleDriveDB.FOLDER_MD5
+                sync_decision = self.is_for_download(file_id, md5sum)
+                if sync_decision != self.NEUTRAL_FLAG:
+                    yield ret_type(sync_decision, "#folder", file_id, path, md5sum)
+
+                # The folder's files are checked (hashed) concurrently.
+                candidates = []
+                for resp in filenames:
+                    md5sum = resp.get("md5Checksum", db.GoogleDriveDB.FOLDER_MD5)
+                    change_datetime = googledrive.convert_google_time_to_datetime(resp['modifiedTime'])
+                    candidates.append((resp, resp['id'], md5sum, change_datetime))
+                for resp, sync_decision in self._filter_for_download(candidates, executor):
+                    md5sum = resp.get("md5Checksum", db.GoogleDriveDB.FOLDER_MD5)
+                    yield ret_type(sync_decision, "#file", resp['id'], os.path.join(path, resp["name"]), md5sum)
 
     def get_last_removed(self, update_token=True):
         # NOTE: if a folder is removed, only that folder deletion is reported (not the folder contents)!
@@ -0,0 +1,40 @@
+"""File system helpers, shared by the crawlers and loaders."""
+
+import os
+import hashlib
+import functools
+
+from pytools import filetools as ft
+
+
+def real_case_filename(path):
+    """Same as ft.real_case_filename, except that each parent directory 
+    is listed only once, instead of once per file. See clear_cache."""
+    parent, name = os.path.split(os.path.abspath(path))
+    try:
+        real_name = _list_real_case_names(parent).get(os.path.normcase(name))
+    except OSError:
+        real_name = None
+    # Not listed (yet), e.g. the file was created after its parent was listed.
+    return real_name if real_name is not None else ft.real_case_filename(path)
+
+@functools.lru_cache(maxsize=1024)
+def _list_real_case_names(dir_path):
+    with os.scandir(dir_path) as it:
+        return { os.path.normcase(entry.name): entry.name for entry in it }
+
+def clear_cache():
+    """Forget directory listings. Call at the start of each sync, so that renamed
+    files don't keep the names they had in an earlier sync."""
+    _list_real_case_names.cache_clear()
+
+MD5_BUFFER_SIZE = 1024 ** 2
+
+def md5sum(path):
+    """Same as ft.md5sum, but reads the file in large chunks into a reused buffer."""
+    md5 = hashlib.md5()
+    buf = memoryview(bytearray(MD5_BUFFER_SIZE))
+    with open(path, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            md5.update(buf[:n])
+    return md5.hexdigest()
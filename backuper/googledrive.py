@@ -12,8 +12,10 @@ import re
 import json
 import time
 import math
+import random
 import logging
 import datetime
+import threading
 import mimetypes
 import concurrent.futures
 from functools import wraps
@@ -21,17 +23,48 @@ from functools import wraps
 from pytools import filetools as ft
 from pytools import progressbar, cache
 
+from . import fsutil
 
+
+# googleapiclient's num_retries: randomized exponential backoff on 5xx, 429 and rate limit 403 errors.
 NUM_RETRIES = 6
-RETRYABLE_HTTP_ERROR_CODES = (403, 500)
+# Rate limits and server errors, for batch requests (which aren't retried by googleapiclient).
+# See is_retryable_error.
+RETRYABLE_HTTP_ERROR_CODES = (429, 500, 502, 503, 504)
+# Drive reports user rate limits as 403 errors, along with permission errors.
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+MAX_BACKOFF = 60  # Seconds.
+
+
+def is_retryable_error(e):
+    """Whether retrying may help with HttpError e. Like googleapiclient's num_retries, 
+    a 403 is only retried if it is a rate limit (and not e.g. a permission error)."""
+    if e.resp.status == 403:
+        return _error_reason(e) in RATE_LIMIT_REASONS
+    return e.resp.status in RETRYABLE_HTTP_ERROR_CODES
+
+def _error_reason(e):
+    try:
+        return json.loads(e.content.decode("utf-8"))["error"]["errors"][0]["reason"]
+    except (AttributeError, ValueError, LookupError, TypeError):
+        return None
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number attempt (1, 2, ...): exponential, capped
+    at MAX_BACKOFF and jittered, so that concurrent workers don't retry in lockstep."""
+    return min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
 
 
 def handle_http_error(silent=False, ignore=False):
-    """Decorator that handles HttpErrors by retrying the decorated function.
+    """Decorator that handles HttpErrors raised by the decorated function.
+
+    Requests are executed with num_retries=NUM_RETRIES, so rate limit and server
+    errors are already retried (with randomized exponential backoff) by googleapiclient.
     
     Keyword arguments:
-        silent: don't raise error if all retries fail (default False)
-        ignore: upon HttpError, ignore it without retrying (default False)
+        silent: don't raise the error, only log it (default False)
+        ignore: upon HttpError, ignore it (default False)
     Returns:
         on success: return what the decorated functions returns
         on HttpError: return None if ignore=True or silent=True
@@ -39,28 +72,16 @@ def handle_http_error(silent=False, ignore=False):
     def decorated(func):
         @wraps(func)
         def inner_decorated(*args, **kwargs):
-            error = None
-            for attempt in range(1, NUM_RETRIES + 1):
-                try:
-                    return func(*args, **kwargs)
-                except HttpError as e:
-                    error = e
-                    if ignore or e.resp.status == 404:
-                        logging.info("Ignoring error {}".format(e))
-                        return
-                    
-                    if e.resp.status in RETRYABLE_HTTP_ERROR_CODES:
-                        sleeptime = 2 ** attempt
-                        time.sleep(sleeptime)
-                    
-                    logging.info("Retrying {func}({args}) due to error {error}".format(func=func.__name__, 
-                                                                                   args=(args, kwargs), 
-                                                                                   error=e))
-            if silent:
-                logging.error("Silenced error {}".format(error))
-                return
-            else:
-                raise error
+            try:
+                return func(*args, **kwargs)
+            except HttpError as e:
+                if ignore or e.resp.status == 404:
+                    logging.info("Ignoring error {}".format(e))
+                    return
+                if silent:
+                    logging.error("Silenced error {}".format(e))
+                    return
+                raise
                 
         return inner_decorated
     return decorated
@@ -76,9 +97,13 @@ def convert_datetime_to_google_time(dtime):
 class GoogleDrive:
     # Note: https://developers.google.com/apis-explorer/#p/drive/v3/ is very handy!
 
-    UPLOAD_CHUNK_SIZE = 4 * 1024 ** 2
+    UPLOAD_CHUNK_SIZE = 16 * 1024 ** 2  # Fewer round trips per resumable upload.
+    # Smaller files are uploaded with a single (multipart) request, instead of a
+    # resumable upload session, which costs an extra request to start.
+    SIMPLE_UPLOAD_LIMIT = 5 * 1024 ** 2
     DOWNLOAD_CHUNK_SIZE = 4 * 1024 ** 2
     BATCH_LIMIT = 32
+    LIST_PAGE_SIZE = 1000  # Max. allowed by files.list.
     CREDENTIALS_FILE = 'credentials.json'
     CLIENT_SECRET_FILE = 'client_secret.json'
 
@@ -95,14 +120,20 @@ class GoogleDrive:
             flags = tools.argparser.parse_args(args=[])
             self.credentials = run_flow(flow, credential_storage, flags)
 
+        # Each thread reuses its own Http object (see _build_request).
+        self._thread_local = threading.local()
         self.drive_service = build('drive', 'v3', credentials=self.credentials, requestBuilder=self._build_request)
 
         # file_id -> metadata response cache.
         self.metadata_cache = cache.LRUcache(32768)  # 2^15
 
     def _build_request(self, _http, *args, **kwargs):
-        # Create a new Http() object for every request
-        http = self.credentials.authorize(httplib2.Http())
+        # Http() objects aren't thread safe, so each thread gets its own.
+        # Reusing it keeps the connection alive between requests.
+        http = getattr(self._thread_local, "http", None)
+        if http is None:
+            http = self.credentials.authorize(httplib2.Http())
+            self._thread_local.http = http
         return HttpRequest(http, *args, **kwargs)
 
     def exit(self): 
@@ -222,19 +253,19 @@ class GoogleDrive:
             mime = 'application/octet-stream'
         
         body = {
-            'name': ft.real_case_filename(file_path),
+            'name': fsutil.real_case_filename(file_path),
             'parents': [folder_id]
         }
 
         # Empty files can't be uploaded with chunks because they aren't resumable.
-        resumable = ft.getsize(file_path) > 0
+        resumable = ft.getsize(file_path) > self.SIMPLE_UPLOAD_LIMIT
         media_body = MediaFileUpload(file_path, mimetype=mime, chunksize=self.UPLOAD_CHUNK_SIZE, resumable=resumable)
         request = self._determine_update_or_insert(body, media_body=media_body, file_id=file_id, fields=fields)
         
         pbar = progressbar.blockbar(desc="UL " + body["name"], bar_width=12)
-        response = None if resumable else request.execute()  # Empty files are not chunked.
+        response = None if resumable else request.execute(num_retries=NUM_RETRIES)  # Small files are not chunked.
         while response is None:
-            status, response = request.next_chunk(num_retries=5)
+            status, response = request.next_chunk(num_retries=NUM_RETRIES)
             pbar.set_progress(status.progress() if status else 1)
         pbar.close()
 
@@ -272,7 +303,7 @@ class GoogleDrive:
             'mimeType': GoogleDrive.FOLDER_MIMETYPE
         }
 
-        return self.drive_service.files().create(body=body).execute()['id']
+        return self.drive_service.files().create(body=body).execute(num_retries=NUM_RETRIES)['id']
 
     def get_modified_time(self, file_id):
         date = self.get_metadata(file_id)['modifiedTime'].rsplit('.', 1)[0]
@@ -310,7 +341,7 @@ class GoogleDrive:
             if not missing:
                 return resp
 
-        new_resp = self.drive_service.files().get(fileId=file_id, fields=fields).execute()
+        new_resp = self.drive_service.files().get(fileId=file_id, fields=fields).execute(num_retries=NUM_RETRIES)
         
         if resp is not None:
             resp.update(new_resp)
@@ -320,17 +351,25 @@ class GoogleDrive:
         
         return resp
 
+    def cache_metadata(self, resp):
+        """Add file metadata obtained elsewhere (e.g. a changes response) to the metadata cache."""
+        cached = self.metadata_cache.get(resp["id"])
+        if cached is not None:
+            cached.update(resp)
+        else:
+            self.metadata_cache[resp["id"]] = dict(resp)
+
     @handle_http_error(ignore=False)
     def update_metadata(self, file_id, fields=None, **kwargs):
         if kwargs:
-            return self.drive_service.files().update(fileId=file_id, body=kwargs, fields=fields).execute()
+            return self.drive_service.files().update(fileId=file_id, body=kwargs, fields=fields).execute(num_retries=NUM_RETRIES)
 
     @handle_http_error(ignore=False)
     def move_file(self, src_id, dest_id):
         """Move src_id to be a child of dest_id."""
         data = self.get_metadata(src_id, fields="parents")
         parents = ",".join(data.get("parents"))
-        self.drive_service.files().update(fileId=src_id, fields="id, parents", addParents=dest_id, removeParents=parents).execute()
+        self.drive_service.files().update(fileId=src_id, fields="id, parents", addParents=dest_id, removeParents=parents).execute(num_retries=NUM_RETRIES)
 
     def rename_file(self, file_id, name):
         self.update_metadata(file_id, name=name)
@@ -341,7 +380,7 @@ class GoogleDrive:
             return filename['name']
 
     def get_file_by_name(self, name, fields="files(id, name, parents)"):
-        return self.drive_service.files().list(q="name='{}'".format(name), fields=fields).execute()["files"]
+        return self.drive_service.files().list(q="name='{}'".format(name), fields=fields).execute(num_retries=NUM_RETRIES)["files"]
 
     def get_all_in_folder(self, folder_id, fields="files(trashed,id,name)", q=None):
         """Yields all (non-trashed) files in a folder (direct children) with fields metadata.
@@ -352,9 +391,9 @@ class GoogleDrive:
         if q:
             search_query = "{search_query} and ({user_q})".format(search_query=search_query, user_q=q)
 
-        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=500)
+        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=self.LIST_PAGE_SIZE)
         while request is not None:
-            response = request.execute()
+            response = request.execute(num_retries=NUM_RETRIES)
 
             for file in response['files']:
                 if not file['trashed']:
@@ -373,9 +412,9 @@ class GoogleDrive:
         if q:
             search_query = "{search_query} and ({user_q})".format(search_query=search_query, user_q=q)
 
-        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=500)
+        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=self.LIST_PAGE_SIZE)
         while request is not None:
-            response = request.execute()
+            response = request.execute(num_retries=NUM_RETRIES)
 
             for file in response['files']:
                 if not file['trashed']:
@@ -392,9 +431,9 @@ class GoogleDrive:
         if q:
             search_query = "{search_query} and ({user_q})".format(search_query=search_query, user_q=q)
 
-        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=500)
+        request = self.drive_service.files().list(q=search_query, fields=fields, pageSize=self.LIST_PAGE_SIZE)
         while request is not None:
-            response = request.execute()
+            response = request.execute(num_retries=NUM_RETRIES)
 
             for folder in response['files']:
                 if not folder['trashed']:
@@ -518,7 +557,7 @@ class GoogleDrive:
 
         files_request = self.drive_service.files().list(**kwargs)
         while files_request is not None:
-            files_resp = files_request.execute()
+            files_resp = files_request.execute(num_retries=NUM_RETRIES)
             result.extend(files_resp['files'])
             files_request = self.drive_service.files().list_next(files_request, files_resp)
 
@@ -551,7 +590,7 @@ class GoogleDrive:
     # @handle_http_error(ignore=False)
     def delete(self, file_id):
         try:
-            self.drive_service.files().delete(fileId=file_id).execute()
+            self.drive_service.files().delete(fileId=file_id).execute(num_retries=NUM_RETRIES)
             logging.info("GD DELETE: %s", file_id)
         except HttpError as e:
             if e.resp.status == 404:  # File doesn't exist. Safe to ignore.
@@ -566,38 +605,80 @@ class GoogleDrive:
                 return True
         return False
 
+    def batch_exists(self, file_ids):
+        """Same as exists, but for many files at once, using batch requests.
+        Returns the set of file_ids that exist (and aren't trashed)."""
+        existing = set()
+        retry_ids = []
+        error = None
+
+        def callback(file_id, response, exception):
+            nonlocal error
+            if exception is None:
+                if not response['trashed']:
+                    existing.add(file_id)
+            elif is_retryable_error(exception):
+                error = exception
+                retry_ids.append(file_id)
+            elif exception.resp.status != 404:
+                raise exception
+
+        file_ids = list(file_ids)
+        for attempt in range(1, NUM_RETRIES + 2):
+            for i in range(0, len(file_ids), self.BATCH_LIMIT):
+                batch = self.drive_service.new_batch_http_request(callback=callback)
+                for file_id in file_ids[i:i + self.BATCH_LIMIT]:
+                    # File ids are unique so we can use them as request ids.
+                    batch.add(self.drive_service.files().get(fileId=file_id, fields='trashed'), request_id=file_id)
+                batch.execute()
+            if not retry_ids:
+                return existing
+            if attempt > NUM_RETRIES:
+                break
+            logging.info("Retrying {} exists requests.".format(len(retry_ids)))
+            time.sleep(backoff_delay(attempt))
+            file_ids = list(retry_ids)
+            retry_ids.clear()
+        raise error
+
     @handle_http_error(ignore=False)
     def get_start_page_token(self):
-        return int(self.drive_service.changes().getStartPageToken().execute()["startPageToken"])
+        return int(self.drive_service.changes().getStartPageToken().execute(num_retries=NUM_RETRIES)["startPageToken"])
 
     # @handle_http_error(ignore=True)
     def get_changes(self, start_page_token=None, fields=None, include_removed=True):
         """Yield response of all changes since start_page_token.
         NOTE: if include_removed is True, trashed files will still be shown."""
 
-        page_token = start_page_token
-
         if fields:
             if "nextPageToken" not in fields:
                 fields = "nextPageToken," + fields
             if "newStartPageToken" not in fields:
                 fields = "newStartPageToken," + fields
 
-        param = {'fields': fields, 'restrictToMyDrive': True, 'pageSize': 500, 'pageToken': start_page_token, 'includeRemoved': include_removed}
+        param = {'fields': fields, 'restrictToMyDrive': True, 'pageSize': 1000, 'includeRemoved': include_removed}
 
-        while page_token is not None:
-            if page_token:
-                param['pageToken'] = page_token
+        def fetch(page_token):
+            return self.drive_service.changes().list(pageToken=page_token, **param).execute(num_retries=NUM_RETRIES)
 
-            changes_request = self.drive_service.changes().list(**param).execute()
+        if start_page_token is None:
+            return
 
-            for change in changes_request['changes']:
-                yield change
+        # Page tokens are chained, so pages can't be requested concurrently.
+        # Instead, the next page is already fetched while the current one is consumed.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="get_changes") as executor:
+            next_page = executor.submit(fetch, start_page_token)
+            while next_page is not None:
+                changes_request = next_page.result()
 
-            if "newStartPageToken" in changes_request:
-                return
+                page_token = changes_request.get('nextPageToken')
+                if "newStartPageToken" in changes_request or page_token is None:
+                    next_page = None
+                else:
+                    next_page = executor.submit(fetch, page_token)
 
-            page_token = changes_request.get('nextPageToken')
+                for change in changes_request['changes']:
+                    yield change
 
 
 class PPGoogleDrive(GoogleDrive):
@@ -106,6 +106,9 @@ class UserSettingsFile(BaseFile):
         # The number of threads to use when downloading/uploading.
         download_threads = 5
         upload_threads = 5
+
+        # The number of threads used to check local files for changes (stat calls and hashing).
+        crawler_threads = 8
         """
         s = textwrap.dedent(s)
         # Write a pretty representation to file, because
@@ -124,8 +127,8 @@ class UserSettingsFile(BaseFile):
     def get_bool(self, option):
         return self.getboolean("Settings", option)
 
-    def get_int(self, option):
-        return self.getint("Settings", option)
+    def get_int(self, option, **kwargs):
+        return self.getint("Settings", option, **kwargs)
 
     def get_regex_rules(self, option):
         # fnmatch -> regex patterns -> single compiled regex
@@ -235,6 +238,8 @@ class Settings:
 
         self.sync_dirs = self.user_settings_file.get_paths_in_option("sync_dirs")
 
+        self._root_folder_id = None
+
     def __enter__(self):
         return self
 
@@ -245,6 +250,8 @@ class Settings:
         self.data_file.write_to_file()
 
     def get_root_folder_id(self, google):
+        if self._root_folder_id is not None:
+            return self._root_folder_id
         folder_id = self.data_file.get_root_folder_id()
         if folder_id is None:
             # Try to use the root Backuper folder if it exists.
@@ -255,6 +262,7 @@ class Settings:
             if folder_id is None:
                 folder_id = google.create_folder("Backuper")
             self.data_file.set_root_folder_id(folder_id)
+        self._root_folder_id = folder_id
         return folder_id
 
     def contains_blacklisted_rules(self, path):
@@ -280,18 +288,26 @@ class Settings:
             return True
         return self.contains_blacklisted_rules(entry)
 
-    def is_blacklisted_parent(self, path, stop):
+    def is_blacklisted_parent(self, path, stop, memo=None):
         """ Check if path or parents of path up to stop are blacklisted. 
             stop should be a list of paths or a string
+            memo is an optional dict of checked paths, shared between calls with the same stop.
+            Use it when checking many paths with common parents.
         """
+        if memo is not None:
+            val = memo.get(path)
+            if val is not None:
+                return val
         if path in stop:
-            return False
-        if self.is_blacklisted(path):
-            return True
-        parent = ft.parent_dir(path)
-        if parent == path:
-            return False
-        return self.is_blacklisted_parent(parent, stop)
+            val = False
+        elif self.is_blacklisted(path):
+            val = True
+        else:
+            parent = ft.parent_dir(path)
+            val = parent != path and self.is_blacklisted_parent(parent, stop, memo)
+        if memo is not None:
+            memo[path] = val
+        return val
 
     def blacklist_path(self, entry):
         if not os.path.exists(entry):
@@ -303,8 +319,9 @@ class Settings:
     def clean_blacklisted_paths(self):
         """Cleans the saved blacklisted_paths, so that only the most common valid paths remain."""
         new_blacklisted_paths = set()
+        memo = dict()
         for entry in self.blacklisted_paths:
-            if os.path.exists(entry) and not self.is_blacklisted_parent(ft.parent_dir(entry), self.sync_dirs):
+            if os.path.exists(entry) and not self.is_blacklisted_parent(ft.parent_dir(entry), self.sync_dirs, memo):
                 new_blacklisted_paths.add(entry)
         self.blacklisted_paths = new_blacklisted_paths
         self.data_file.set_blacklisted_paths(self.blacklisted_paths)
@@ -1,41 +1,63 @@
+import io
 import os
 import logging
-import tempfile
+import zipfile
 
 from pytools import filetools as ft
 
 
 TREE_LOGS_FOLDER_NAME = "BackuperTreeLogs"
 
+# ft.tree writes one line per entry. Buffer them, instead of making a write
+# (or a compression) call per line.
+WRITE_BUFFER_SIZE = 1024 ** 2
 
-def create_tree_log(path_to_log, dst_dir, file_name=None, files=False):
+
+def get_tree_log_name(path_to_log):
+    return "{}_{}.log".format(ft.path_filter(path_to_log), ft.get_current_date_string())
+
+def write_tree_log(path_to_log, stream, file_name, files=False):
     logging.info("TREE LOG: Starting %s.", path_to_log)
     print("TREE: {} ......... ".format(path_to_log), end='', flush=True)
 
-    if file_name is None:
-        file_name = "{}_{}.log".format(ft.path_filter(path_to_log), ft.get_current_date_string())
-    
-    log_file_path = os.path.join(dst_dir, file_name)
-    with open(log_file_path, "w", encoding="utf8") as f:
-        ft.tree(path_to_log, files=files, stream=f)
+    ft.tree(path_to_log, files=files, stream=stream)
 
     print("{} DONE.".format(file_name), flush=True)
     logging.info("TREE LOG: Finished %s.", path_to_log)
+
+def create_tree_log(path_to_log, dst_dir, file_name=None, files=False):
+    if file_name is None:
+        file_name = get_tree_log_name(path_to_log)
+    
+    log_file_path = os.path.join(dst_dir, file_name)
+    with open(log_file_path, "w", encoding="utf8", buffering=WRITE_BUFFER_SIZE) as f:
+        write_tree_log(path_to_log, f, file_name, files=files)
     
     return log_file_path
 
-def create_tree_logs(conf, dst_dir):
+def get_tree_log_paths(conf):
+    """Yield (path, files) pairs of all paths to log."""
     user_settings = conf.user_settings_file
     for path in user_settings.get_paths_in_option("tree_with_files"):
-        create_tree_log(path, dst_dir, files=True)
+        yield path, True
     for path in user_settings.get_paths_in_option("tree_dirs"):
-        create_tree_log(path, dst_dir, files=False)
+        yield path, False
+
+def create_tree_logs(conf, dst_dir):
+    for path, files in get_tree_log_paths(conf):
+        create_tree_log(path, dst_dir, files=files)
 
 def create_tree_logs_zip(conf, dst_dir):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        create_tree_logs(conf, tmpdir)
-        zip_name = "TreeLogs{}".format(ft.get_current_date_string())
-        return ft.zip_dir(tmpdir, dst_filename=zip_name, dst_dir=dst_dir)
+    """The logs are written straight into the zip, without temporary files."""
+    zip_name = "TreeLogs{}.zip".format(ft.get_current_date_string())
+    zip_path = os.path.join(dst_dir, zip_name)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, files in get_tree_log_paths(conf):
+            file_name = get_tree_log_name(path)
+            zip_stream = io.BufferedWriter(zf.open(file_name, "w", force_zip64=True), WRITE_BUFFER_SIZE)
+            with io.TextIOWrapper(zip_stream, encoding="utf8") as f:
+                write_tree_log(path, f, file_name, files=files)
+    return zip_path
 
 def get_or_create_tree_folder_id(conf, google, root_id):
     tree_folder_id = conf.data_file.get_trees_folder_id()
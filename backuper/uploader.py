@@ -1,9 +1,8 @@
 import os
 from collections import namedtuple
 
-from pytools import filetools as ft
-
 from . import database as db
+from . import fsutil
 from . import _loader
 
 
@@ -23,26 +22,33 @@ class DriveUploader:
         self.root_folder_id = root_folder_id
 
     def upload_file(self, path, folder_id=None, file_id=None):
+        return self._upload_file(path, folder_id=folder_id, file_id=file_id)['id']
+
+    def _upload_file(self, path, folder_id=None, file_id=None, fields=None):
+        """Returns the upload response, with the requested fields."""
         folder_id = folder_id or self.root_folder_id
-        resp = self.google.upload_file(path, folder_id=folder_id, file_id=file_id)
-        return resp['id']
+        return self.google.upload_file(path, folder_id=folder_id, file_id=file_id, fields=fields)
 
     def create_dir(self, path, folder_name=None, parent_folder_id=None):
         parent_folder_id = parent_folder_id or self.root_folder_id
-        folder_name = folder_name or ft.real_case_filename(path)
+        folder_name = folder_name or fsutil.real_case_filename(path)
         return self.google.create_folder(folder_name, parent_id=parent_folder_id)
 
+    # Upload queues hold at most this many entries per thread.
+    QUEUE_SIZE_PER_THREAD = 4
+
     def start_upload_queue(self, n_threads=5):
         """N threads will upload items from a queue, until the queue is empty.
 
         Returns an UploadQueue object. Populate the queue with DUQEntry
         objects using the queue's put() method. When done, call wait_for_queue(q).
+        put() blocks while the queue is full.
 
         When enqueuing files/dirs that have parents, make sure the parents 
         have already been created.
         """
         return _loader.start_queue(self.process_queue_entry, n_threads=n_threads, 
-            thread_prefix="DriveUploader")
+            thread_prefix="DriveUploader", maxsize=n_threads * self.QUEUE_SIZE_PER_THREAD)
 
     def process_queue_entry(self, qentry):
         """Subclasses can override this function and DUQEntry's definition."""
@@ -79,10 +85,14 @@ class DBDriveUploader(DriveUploader):
         if folder_id is None:
             folder_id = self.get_parent_folder_id(entry)
         file_id = db.GoogleDriveDB.get_stored_path_id(entry)
-        file_id = super().upload_file(entry, folder_id, file_id)
+        # Google Drive returns the checksum of the uploaded content, so the 
+        # file doesn't have to be read again to hash it.
+        resp = self._upload_file(entry, folder_id, file_id, fields="id,md5Checksum")
+        file_id = resp['id']
         if self.update_db:
-            db.GoogleDriveDB.create_or_update(path=entry, drive_id=file_id, 
-                date_modified_on_disk=ft.date_modified(entry), md5sum=ft.md5sum(entry))
+            md5sum = resp.get('md5Checksum') or fsutil.md5sum(entry)
+            db.GoogleDriveDB.create_or_update_deferred(path=entry, drive_id=file_id, 
+                md5sum=md5sum, **db.date_fields(entry))
         return file_id
 
     def create_dir(self, path):
@@ -92,8 +102,8 @@ class DBDriveUploader(DriveUploader):
             parent_id = self.get_parent_folder_id(entry)
             folder_id = super().create_dir(entry, parent_folder_id=parent_id)
             if self.update_db:
-                db.GoogleDriveDB.create(path=entry, drive_id=folder_id, 
-                    date_modified_on_disk=ft.date_modified(entry), md5sum=db.GoogleDriveDB.FOLDER_MD5)
+                db.GoogleDriveDB.create_or_update_deferred(path=entry, drive_id=folder_id, 
+                    md5sum=db.GoogleDriveDB.FOLDER_MD5, **db.date_fields(entry))
         return folder_id
 
     def process_queue_entry(self, qentry):
@@ -102,3 +112,10 @@ class DBDriveUploader(DriveUploader):
             self.create_dir(qentry)
         else:
             self.upload_file(qentry)
+
+    def wait_for_queue(self, q, stop=True):
+        """Override. Also writes the deferred database entries."""
+        try:
+            return super().wait_for_queue(q, stop=stop)
+        finally:
+            db.GoogleDriveDB.flush()
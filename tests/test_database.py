@@ -1,3 +1,7 @@
+import datetime
+
+import pytest
+
 from backuper import database as db
 
 def list_all():
@@ -10,7 +14,104 @@ def list_paths_contains(path):
         q = gddb.model.select().where(gddb.model.path.contains(path))
         for archive in q.iterator():
             print(archive.path)
-    
+
+
+# The tests below use a fresh database file, don't need Google Drive and run with pytest.
+
+NOW = datetime.datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def gddb(tmp_path, monkeypatch):
+    GDDB = db.GoogleDriveDB
+    db.db.init(str(tmp_path / "archived.db"))
+    for attr, value in [("_users", 0), ("_schema_ready", False), ("_cache", None), 
+                        ("_id_cache", None), ("_pending", []), ("_flush_error", None)]:
+        monkeypatch.setattr(GDDB, attr, value)
+    GDDB.init()
+    yield GDDB
+    while GDDB._users > 0:
+        GDDB.close()
+    db.db.init(db.DB_FILE_PATH)
+
+def _defer(gddb, path, drive_id):
+    gddb.create_or_update_deferred(path=path, drive_id=drive_id, md5sum="", 
+                                   date_modified_on_disk=NOW, mtime_ns=0)
+
+def _paths(gddb):
+    return sorted(row[0] for row in gddb.model.select(gddb.model.path).tuples())
+
+def test_deferred_rows_flushed_on_close(gddb):
+    _defer(gddb, "/a", "A")
+    # Only visible through the cache, until flushed.
+    assert gddb.get_cached("/a")[0] == "A"
+    assert _paths(gddb) == []
+    gddb.init()
+    gddb.close()
+    assert _paths(gddb) == ["/a"]
+
+def test_init_close_refcount(gddb):
+    gddb.init()
+    gddb.close()
+    assert not db.db.is_closed()  # The fixture's init is still open.
+    gddb.close()
+    assert db.db.is_closed()
+    gddb.init()
+
+def test_cache_after_remove_many(gddb):
+    _defer(gddb, "/a", "A")
+    _defer(gddb, "/b", "B")
+    gddb.remove_many("drive_id", ["A"])
+    assert gddb.get_cached("/a") is None
+    assert gddb.get_cached_path("A") is None
+    assert gddb.get_cached("/b")[0] == "B"
+    gddb.flush()
+    assert _paths(gddb) == ["/b"]
+
+def test_cache_after_remove_containing(gddb):
+    _defer(gddb, "/a", "A")
+    _defer(gddb, "/a/x", "X")
+    _defer(gddb, "/b", "B")
+    gddb.remove_containing(["/a"])
+    assert gddb.get_cached("/a") is None
+    assert gddb.get_cached("/a/x") is None
+    assert gddb.get_cached_path("X") is None
+    gddb.flush()
+    assert _paths(gddb) == ["/b"]
+
+def test_id_cache_after_drive_id_change(gddb):
+    _defer(gddb, "/a", "A")
+    _defer(gddb, "/a", "A2")
+    assert gddb.get_cached_path("A2") == "/a"
+    assert gddb.get_cached_path("A") is None
+    gddb.flush()
+    assert gddb.get("path", "/a").drive_id == "A2"
+
+def test_id_cache_after_move(gddb):
+    _defer(gddb, "/a", "A")
+    _defer(gddb, "/b", "A")
+    assert gddb.get_cached_path("A") == "/b"
+    assert gddb.get_cached("/a") is None
+
+def test_failed_flush_keeps_rows(gddb):
+    _defer(gddb, "/a", "A")
+    gddb.create_or_update_deferred(path="/b", drive_id="B", date_modified_on_disk=None)  # NOT NULL
+    with pytest.raises(db.peewee.IntegrityError):
+        gddb.flush()
+    assert len(gddb._pending) == 2
+    gddb._pending.pop()
+    gddb.flush()
+    assert _paths(gddb) == ["/a"]
+
+def test_background_flush_error_raised_by_next_flush(gddb):
+    gddb.create_or_update_deferred(path="/b", drive_id="B", date_modified_on_disk=None)  # NOT NULL
+    gddb._writer.submit(gddb._background_flush).result()
+    with pytest.raises(db.peewee.IntegrityError):
+        gddb.flush()
+    assert len(gddb._pending) == 1
+    gddb._pending.clear()
+    gddb._writer.submit(db.db.close).result()  # The writer's connection.
+
 
 if __name__ == "__main__":
     list_paths_contains("backuper")
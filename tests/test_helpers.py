@@ -0,0 +1,88 @@
+import os
+import json
+from collections import namedtuple
+from types import SimpleNamespace
+
+import pytest
+
+from backuper import _helpers
+
+
+Archive = namedtuple("Archive", ["id", "path", "drive_id"])
+
+
+def test_group_by_root():
+    folder = os.path.join(os.sep, "a", "b")
+    archives = [
+        Archive(1, folder, "B"),
+        Archive(2, folder + ".txt", "BT"),  # Sorts between folder and its contents.
+        Archive(3, os.path.join(folder, "c"), "C"),
+        Archive(4, os.path.join(folder, "d"), "D"),
+        Archive(5, folder + "c", "X"),  # Extends the folder's name.
+    ]
+    roots, children = _helpers.group_by_root(archives)
+    assert sorted(roots) == ["B", "BT", "X"]
+    assert sorted(children["B"]) == [1, 3, 4]
+    assert children["BT"] == [2]
+    assert children["X"] == [5]
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status, reason=""):
+        super().__init__(status, reason)
+        self.resp = SimpleNamespace(status=status)
+        self.content = json.dumps({"error": {"errors": [{"reason": reason}]}}).encode()
+
+class FakeDrive:
+    BATCH_LIMIT = 2
+
+    def __init__(self, errors):
+        self.errors = errors  # file_id -> list of errors, one per request.
+        self.requests = []
+
+    def batch_delete(self, file_ids, callback):
+        for file_id in file_ids:
+            self.requests.append(file_id)
+            errors = self.errors.get(file_id)
+            callback(file_id, None, errors.pop(0) if errors else None)
+
+class FakeProgressbar:
+    def update(self):
+        pass
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(_helpers.time, "sleep", lambda seconds: None)
+
+def _delete(google, ids, removed_ids, **kwargs):
+    paths = { file_id: "/" + file_id for file_id in ids }
+    _helpers.batch_delete_in_google_drive(google, paths, removed_ids, pbar=FakeProgressbar(), **kwargs)
+
+def test_batch_delete_retries():
+    google = FakeDrive({
+        "a": [FakeHttpError(429)],
+        "b": [FakeHttpError(403, "userRateLimitExceeded"), FakeHttpError(503)],
+        "c": [FakeHttpError(404)],  # Already gone.
+    })
+    removed_ids = []
+    throttle = _helpers.BatchThrottle(min_interval=0)
+    _delete(google, "abcd", removed_ids, throttle=throttle)
+    assert sorted(removed_ids) == ["a", "b", "c", "d"]
+    assert google.requests.count("b") == 3
+    assert throttle.interval > 0  # Slowed down by the rate limits.
+
+def test_batch_delete_partial_failure():
+    google = FakeDrive({ "c": [FakeHttpError(403, "insufficientFilePermissions")] })
+    removed_ids = []
+    with pytest.raises(FakeHttpError):
+        _delete(google, "abcd", removed_ids)
+    # Not retried. Files deleted before the error are reported.
+    assert google.requests == ["a", "b", "c"]
+    assert removed_ids == ["a", "b"]
+
+def test_batch_delete_retry_limit():
+    google = FakeDrive({ "a": [FakeHttpError(500)] * 10 })
+    removed_ids = []
+    with pytest.raises(FakeHttpError):
+        _delete(google, "ab", removed_ids)
+    assert removed_ids == ["b"]
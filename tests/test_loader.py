@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+from backuper import _loader
+
+
+def test_put_after_worker_exception():
+    failed = threading.Event()
+
+    def fn(item):
+        failed.set()
+        raise ValueError(item)
+
+    q = _loader.start_queue(fn, n_threads=1, maxsize=1)
+    q.put(1)
+    failed.wait()
+    q.join()
+    assert isinstance(q.exception, ValueError)
+    # Dropped instead of blocking on the full (bounded) queue.
+    for i in range(10):
+        q.put(i, timeout=1)
+    assert q.qsize() == 0
+    with pytest.raises(ValueError):
+        _loader.wait_for_queue(q)
+
+def test_wait_for_queue():
+    done = []
+    q = _loader.start_queue(done.append, n_threads=2, maxsize=2)
+    for i in range(10):
+        q.put(i)
+    _loader.wait_for_queue(q)
+    assert sorted(done) == list(range(10))